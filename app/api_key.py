@@ -0,0 +1,225 @@
+from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
+from fastapi import HTTPException, Depends
+
+import hashlib
+import hmac
+import secrets
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable
+
+from app.postgres_connect import TestBcryptDBConnection
+from app.auth_token import AuthToken
+from app.person import ApiClient, TokenData
+
+
+class ApiKeyAuth:
+    """Credentials for machine clients.
+
+    Keys are random tokens stored only as HMAC-SHA256 digests under a unique
+    index, so verifying one is a single indexed lookup and a constant-time
+    compare instead of a bcrypt check. Keys live on the database's catalog
+    connection, next to the first shard.
+    """
+
+    api_key_scheme = APIKeyHeader(name="X-API-Key", auto_error=False)
+    bearer_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
+    key_prefix = "uak_"
+    secret_key: bytes
+    database: TestBcryptDBConnection | None = None
+
+    def __init__(self, secret_key: str, database: TestBcryptDBConnection | None = None):
+        ApiKeyAuth.secret_key = secret_key.encode("utf-8")
+        ApiKeyAuth.database = database
+
+    @staticmethod
+    def digest(key: str) -> bytes:
+        """Return the keyed digest under which an API key is stored."""
+        return hmac.new(ApiKeyAuth.secret_key, key.encode("utf-8"), hashlib.sha256).digest()
+
+    @staticmethod
+    def create_table() -> None:
+        """Create the api_keys table in the database if it does not exist.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS api_keys (
+                id SERIAL PRIMARY KEY,
+                owner_email VARCHAR(200) NOT NULL,
+                name VARCHAR(100) NOT NULL,
+                digest BYTEA UNIQUE NOT NULL,
+                scopes TEXT[] NOT NULL DEFAULT '{}',
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                expires_at TIMESTAMPTZ,
+                revoked_at TIMESTAMPTZ
+            );
+            CREATE INDEX IF NOT EXISTS api_keys_owner_email ON api_keys (owner_email);
+            """)
+        connection.commit()
+
+    @staticmethod
+    def issue_key(owner_email: str, name: str, scopes: list[str], expires_in_days: int | None = None) -> dict[str, Any]:
+        """Issue a new API key.
+
+        Arguments:
+            owner_email -- The email of the person the key acts for.
+            name -- A label identifying the client using the key.
+            scopes -- The scopes granted to the key.
+
+        Keyword Arguments:
+            expires_in_days -- The number of days until the key expires (default None, never).
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            The stored key metadata together with the plaintext key.
+        """
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        key = ApiKeyAuth.key_prefix + secrets.token_urlsafe(32)
+        expires_at = datetime.now(timezone.utc) + timedelta(days=expires_in_days) if expires_in_days else None
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(t"INSERT INTO api_keys (owner_email, name, digest, scopes, expires_at) \
+                        VALUES ({owner_email}, {name}, {ApiKeyAuth.digest(key)}, {scopes}, {expires_at}) \
+                        RETURNING *")
+            connection.commit()
+            created: dict[str, Any] = cur.fetchone() # type: ignore
+            return {**created, "key": key}
+
+    @staticmethod
+    def list_keys(owner_email: str) -> list[dict[str, Any]]:
+        """Retrieve the metadata of every key issued by a person.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(t"SELECT * FROM api_keys WHERE owner_email = {owner_email} ORDER BY id ASC")
+            rows: list[dict] = cur.fetchall()
+        connection.commit()
+        return rows
+
+    @staticmethod
+    def revoke_key(owner_email: str, key_id: int) -> dict[str, Any] | None:
+        """Revoke a key issued by a person.
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            The revoked key's metadata, or None if the person has no such key.
+        """
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(t"UPDATE api_keys SET revoked_at = COALESCE(revoked_at, now()) \
+                        WHERE id = {key_id} AND owner_email = {owner_email} \
+                        RETURNING *")
+            connection.commit()
+            return cur.fetchone()
+
+    @staticmethod
+    def revoke_owner_keys(owner_email: str) -> int:
+        """Revoke every key issued by a person, when their account is deleted.
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            The number of keys revoked.
+        """
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(t"UPDATE api_keys SET revoked_at = now() \
+                        WHERE owner_email = {owner_email} AND revoked_at IS NULL")
+            revoked = cur.rowcount
+        connection.commit()
+        return revoked
+
+    @staticmethod
+    async def get_current_client(key: str | None = Depends(api_key_scheme)) -> ApiClient:
+        if ApiKeyAuth.database is None:
+            raise ValueError("No database connection. Call connect() first.")
+
+        if key is None or not key.startswith(ApiKeyAuth.key_prefix):
+            raise HTTPException(status_code=401, detail="Invalid API key.")
+
+        digest = ApiKeyAuth.digest(key)
+        connection = ApiKeyAuth.database.connection_for()
+        with connection.cursor() as cur:
+            cur.execute(t"SELECT id, owner_email, digest, scopes, expires_at, revoked_at \
+                        FROM api_keys WHERE digest = {digest}")
+            row: dict | None = cur.fetchone()
+        connection.commit()
+
+        if row is None or not hmac.compare_digest(bytes(row['digest']), digest):
+            raise HTTPException(status_code=401, detail="Invalid API key.")
+        if row['revoked_at'] is not None:
+            raise HTTPException(status_code=401, detail="API key revoked.")
+        if row['expires_at'] is not None and row['expires_at'] <= datetime.now(timezone.utc):
+            raise HTTPException(status_code=401, detail="API key expired.")
+        return ApiClient(key_id=row['id'], owner_email=row['owner_email'], scopes=row['scopes'])
+
+    @staticmethod
+    def require_scopes(*scopes: str) -> Callable[..., Awaitable[ApiClient]]:
+        """Build a dependency that accepts only API keys granted every given scope."""
+        async def dependency(client: ApiClient = Depends(ApiKeyAuth.get_current_client)) -> ApiClient:
+            missing = [scope for scope in scopes if scope not in client.scopes]
+            if missing:
+                raise HTTPException(status_code=403, detail=f"API key is missing scopes: {', '.join(missing)}")
+            return client
+        return dependency
+
+    @staticmethod
+    def user_or_scopes(*scopes: str) -> Callable[..., Awaitable[TokenData]]:
+        """Build a dependency that accepts a signed-in user or an API key granted every given scope.
+
+        Requests with an API key act for the key's owner.
+        """
+        check_scopes = ApiKeyAuth.require_scopes(*scopes)
+
+        async def dependency(
+            key: str | None = Depends(ApiKeyAuth.api_key_scheme),
+            token: str | None = Depends(ApiKeyAuth.bearer_scheme),
+        ) -> TokenData:
+            if key is not None:
+                client = await check_scopes(await ApiKeyAuth.get_current_client(key))
+                return TokenData(email=client.owner_email)
+            if token is None:
+                raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+            return await AuthToken.get_current_active_user(await AuthToken.get_current_user(token))
+        return dependency
+
+    @staticmethod
+    def optional_scopes(*scopes: str) -> Callable[..., Awaitable[ApiClient | None]]:
+        """Build a dependency for public endpoints that also accept API keys.
+
+        Requests without a key pass anonymously, a key that is sent must be
+        valid and granted every given scope.
+        """
+        check_scopes = ApiKeyAuth.require_scopes(*scopes)
+
+        async def dependency(key: str | None = Depends(ApiKeyAuth.api_key_scheme)) -> ApiClient | None:
+            if key is None:
+                return None
+            return await check_scopes(await ApiKeyAuth.get_current_client(key))
+        return dependency
@@ -16,11 +16,13 @@ class AuthToken:
     secret_key: str
     algorithm: str
     database: TestBcryptDBConnection | None = None
+    admin_emails: frozenset[str] = frozenset()
     
-    def __init__(self, secret_key: str, algorithm: str = "HS256", database: TestBcryptDBConnection | None = None):
+    def __init__(self, secret_key: str, algorithm: str = "HS256", database: TestBcryptDBConnection | None = None, admin_emails: frozenset[str] = frozenset()):
         AuthToken.secret_key = secret_key
         AuthToken.algorithm = algorithm
         AuthToken.database = database 
+        AuthToken.admin_emails = admin_emails
         
 
     @staticmethod
@@ -50,16 +52,14 @@ class AuthToken:
     async def get_current_user(
         token: str = Depends(oauth_scheme)
     ) -> TokenData:
-        if AuthToken.database is None or AuthToken.database.connection is None:
+        if AuthToken.database is None:
             raise ValueError("No database connection. Call connect() first.")
         
         token_data: TokenData = AuthToken.verify_token(token)
-        with AuthToken.database.connection.cursor() as cur:
-            cur.execute(t"SELECT email FROM test_bcrypt WHERE email = {token_data.email}")
-            user: dict | None = cur.fetchone()
-            if user is None:
-                raise HTTPException(status_code=404, detail="User not found.")
-            return token_data
+        user: dict | None = AuthToken.database.execute_for(token_data.email, t"SELECT email FROM test_bcrypt WHERE email = {token_data.email}")
+        if user is None:
+            raise HTTPException(status_code=404, detail="User not found.")
+        return token_data
         
     @staticmethod
     async def get_current_active_user(current_user: TokenData = Depends(get_current_user)) -> TokenData:
@@ -67,4 +67,8 @@ class AuthToken:
             raise HTTPException(status_code=400, detail="Inactive user.")
         return current_user
 
-
+    @staticmethod
+    async def get_current_admin_user(current_user: TokenData = Depends(get_current_active_user)) -> TokenData:
+        if current_user.email not in AuthToken.admin_emails:
+            raise HTTPException(status_code=403, detail="Admin privileges required.")
+        return current_user
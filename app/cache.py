@@ -0,0 +1,41 @@
+import time
+from collections import OrderedDict
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """A small in-process LRU cache whose entries expire after a fixed time."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = 30.0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Hashable) -> Any | None:
+        """Return the cached value for a key, or None if it is missing or expired."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entry when full."""
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        """Remove a key from the cache if present."""
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """Remove every entry from the cache."""
+        self._entries.clear()
@@ -0,0 +1,132 @@
+"""Generate a deterministic synthetic test_bcrypt dataset for load and scale testing.
+
+    python -m app.generate_users --count 1000000 --seed 42
+    python -m app.generate_users --count 1000 --fast
+
+The same seed and --today always produce the same users. User number i has the password
+password-<seed>-<i % password pool>. Bcrypt hashes use random salts, so only the
+hashes differ between runs. Emails include the seed, so datasets generated with
+different seeds can be loaded into the same database.
+"""
+import argparse
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, datetime, time, timedelta, timezone
+from functools import partial
+from typing import Any, Iterator
+
+from app.password_handler import PasswordBcrypt
+from app.person import PersonCreate
+from app.sharding import ShardedBcryptDBConnection
+
+
+FIRST_NAMES = {
+    "Male": [
+        "James", "John", "Robert", "Michael", "William", "David", "Richard", "Joseph", "Thomas", "Daniel",
+        "Matthew", "Anthony", "Mark", "Paul", "Steven", "Andrew", "Joshua", "Kevin", "Brian", "Oleksandr",
+        "Daniil", "Dmytro", "Ivan", "Mateo", "Lucas", "Noah", "Liam", "Ethan", "Hiroshi", "Arjun",
+    ],
+    "Female": [
+        "Mary", "Patricia", "Jennifer", "Linda", "Elizabeth", "Barbara", "Susan", "Jessica", "Sarah", "Karen",
+        "Lisa", "Nancy", "Sandra", "Ashley", "Emily", "Olivia", "Emma", "Sophia", "Isabella", "Olha",
+        "Anastasiia", "Kateryna", "Yuliia", "Valentina", "Camila", "Aiko", "Priya", "Fatima", "Chloe", "Mia",
+    ],
+}
+LAST_NAMES = [
+    "Smith", "Johnson", "Williams", "Brown", "Jones", "Garcia", "Miller", "Davis", "Rodriguez", "Martinez",
+    "Hernandez", "Lopez", "Gonzalez", "Wilson", "Anderson", "Thomas", "Taylor", "Moore", "Jackson", "Martin",
+    "Lee", "Perez", "Thompson", "White", "Harris", "Sanchez", "Clark", "Ramirez", "Lewis", "Robinson",
+    "Shevchenko", "Kovalenko", "Bondarenko", "Tkachenko", "Kravchenko", "Novak", "Tanaka", "Sato", "Patel", "Kim",
+]
+EMAIL_DOMAINS = ["gmail.com", "outlook.com", "yahoo.com", "icloud.com", "proton.me", "example.com"]
+GENDERS = ["Male", "Female", "Not specified"]
+GENDER_WEIGHTS = [0.49, 0.49, 0.02]
+SIGNUP_DAYS = 730
+
+
+def password_for(seed: int, index: int, password_pool: int) -> str:
+    """Return the plaintext password of the generated user with a given index."""
+    return f"password-{seed}-{index % password_pool}"
+
+
+def generate_people(count: int, seed: int, today: date) -> Iterator[dict[str, Any]]:
+    """Yield deterministic fake users without passwords.
+
+    Ages follow a normal distribution around 35 clipped to 18..90 and signups
+    grow towards the present over the last two years.
+
+    Arguments:
+        count -- The number of users to generate.
+        seed -- The random seed.
+        today -- The date ages and signup days are relative to.
+    """
+    generator = random.Random(seed)
+    for index in range(count):
+        gender = generator.choices(GENDERS, GENDER_WEIGHTS)[0]
+        first_name = generator.choice(FIRST_NAMES.get(gender) or FIRST_NAMES[generator.choice(["Male", "Female"])])
+        last_name = generator.choice(LAST_NAMES)
+        age_years = min(max(generator.gauss(35, 13), 18), 90)
+        birth_date = today - timedelta(days=int(age_years * 365.25))
+        days_ago = int(SIGNUP_DAYS * (1 - generator.random() ** 0.5))
+        created_at = datetime.combine(today - timedelta(days=days_ago), time(), timezone.utc) \
+            + timedelta(seconds=generator.randrange(86400))
+        yield {
+            "first_name": first_name,
+            "last_name": last_name,
+            "gender": gender,
+            "age": PersonCreate.calculate_age(birth_date),
+            "birth_date": birth_date,
+            "email": f"{first_name}.{last_name}.{seed}.{index}@{generator.choice(EMAIL_DOMAINS)}".lower(),
+            "created_at": created_at,
+        }
+
+
+def hash_password_pool(seed: int, password_pool: int, rounds: int, workers: int) -> list[str]:
+    """Hash every distinct password of the pool in parallel worker processes."""
+    passwords = [password_for(seed, index, password_pool) for index in range(password_pool)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(partial(PasswordBcrypt.hash_password, rounds=rounds), passwords, chunksize=16))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load deterministic fake users into test_bcrypt.")
+    parser.add_argument("--count", type=int, required=True, help="Number of users to generate.")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed of the dataset.")
+    parser.add_argument("--password-pool", type=int, default=1000, help="Number of distinct passwords, each hashed once.")
+    parser.add_argument("--rounds", type=int, default=12, help="Bcrypt cost factor of the hashes.")
+    parser.add_argument("--fast", action="store_true", help="Use the minimum bcrypt cost factor, for fixtures.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Processes used for hashing.")
+    parser.add_argument("--batch-size", type=int, default=10_000, help="Users loaded per COPY.")
+    parser.add_argument("--today", type=date.fromisoformat, default=date.today(), help="Reference date of ages and signups, YYYY-MM-DD.")
+    args = parser.parse_args()
+
+    password_pool = max(1, min(args.password_pool, args.count))
+    rounds = 4 if args.fast else args.rounds
+    print(f"Hashing {password_pool} passwords with cost factor {rounds}.")
+    hashes = hash_password_pool(args.seed, password_pool, rounds, args.workers)
+
+    database = ShardedBcryptDBConnection()
+    database.connect()
+    try:
+        database.create_table_bcrypt()
+        database.create_stats_bcrypt()
+        batch: list[dict[str, Any]] = []
+        for index, person in enumerate(generate_people(args.count, args.seed, args.today)):
+            person["hash_password"] = hashes[index % password_pool]
+            batch.append(person)
+            if len(batch) == args.batch_size:
+                database.copy_data_bcrypt(batch)
+                print(f"Loaded {index + 1} of {args.count} users.")
+                batch = []
+        if batch:
+            database.copy_data_bcrypt(batch)
+        database.rollup_stats_bcrypt()
+        database.create_search_indexes_bcrypt()
+        print(f"Loaded {args.count} users.")
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
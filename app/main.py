@@ -1,93 +1,210 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.security import OAuth2PasswordRequestForm
 
+import asyncio
 import os
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
 
-from app.postgres_connect import TestBcryptDBConnection
-from app.person import PersonCreate, PersonUpdate, PersonBcrypt, TokenData, PersonTokenResponse
+from app.sharding import ShardedBcryptDBConnection
+from app.person import PersonCreate, PersonUpdate, PersonBcrypt, PersonResponse, PersonStats, TokenData, PersonTokenResponse, \
+    ApiKeyCreate, ApiKeyResponse, ApiKeyCreated, ApiClient
 from app.auth_token import AuthToken
+from app.api_key import ApiKeyAuth
+from app.profiler import SamplingProfiler, LoopWatchdog
+from app.cache import TTLCache
+from app.load_control import AdmissionController, AdmissionMiddleware, DeadlineExceeded
+from app.single_flight import SingleFlight, CredentialKey
 
-app: FastAPI = FastAPI() # fastapi dev /Users/Daniil/Desktop/Project/app/main.py --port 9999
-database: TestBcryptDBConnection = TestBcryptDBConnection()
+database: ShardedBcryptDBConnection = ShardedBcryptDBConnection()
 database.connect()
 SECRET_KEY: str | None = os.getenv("SECRET_KEY")
 if SECRET_KEY is None:
     raise ValueError("SECRET_KEY not found in environment variables.")
 ALGORITHM = "HS256"
-auth_token = AuthToken(secret_key=SECRET_KEY, algorithm=ALGORITHM, database=database)
+# Admin rights follow the email in a token and anyone can sign up with an unclaimed
+# email, so every address listed here must already be a registered account.
+ADMIN_EMAILS = frozenset(email.strip() for email in os.getenv("ADMIN_EMAILS", "").split(",") if email.strip())
+auth_token = AuthToken(secret_key=SECRET_KEY, algorithm=ALGORITHM, database=database, admin_emails=ADMIN_EMAILS)
+api_key_auth = ApiKeyAuth(secret_key=os.getenv("API_KEY_SECRET") or SECRET_KEY, database=database)
+
+MAX_PROFILE_SECONDS = 60
+profiler = SamplingProfiler()
+watchdog = LoopWatchdog(threshold=float(os.getenv("LOOP_STALL_THRESHOLD_MS", "100")) / 1000)
+
+MAX_SEARCH_LIMIT = 50
+search_cache = TTLCache(max_size=1024, ttl=30)
+
+
+def person_etag(person: dict) -> str:
+    """Build a strong ETag from a person's id and row version."""
+    return f'"{person["id"]}-{person["version"]}"'
+
+
+def current_etag(email: str) -> str | None:
+    """Read a person's current ETag with an indexed lookup of only its id and version.
+
+    Every worker and replica sees the same row version, so a conditional GET
+    answered from it is never stale, and a 304 skips loading the full record.
+    """
+    row: dict | None = database.execute_for(email, t"SELECT id, version FROM test_bcrypt WHERE email = {email}")
+    return None if row is None else person_etag(row)
+
+
+def etag_matches(if_none_match: str | None, etag: str | None) -> bool:
+    """Check an If-None-Match header value against an ETag."""
+    if if_none_match is None or etag is None:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+credential_key = CredentialKey()
+credential_flights = SingleFlight()
+token_flights = SingleFlight()
+
+
+async def check_credentials(email: str, password: str) -> bool | None:
+    """Check an email and password, sharing the work between identical concurrent requests.
+
+    The bcrypt check runs in a worker thread so that the event loop stays free
+    and identical requests arriving meanwhile can join it.
+
+    Returns:
+        True if the password matches, False if not, None if no person has this email.
+    """
+    async def check() -> bool | None:
+        hashed_password: str | None = database.get_hashed_password(email=email)
+        if hashed_password is None:
+            return None
+        return await asyncio.to_thread(PersonCreate.password_bcrypt_check, password, hashed_password)
+    
+    return await credential_flights.do(credential_key(email, password), check, saves=lambda matched: matched is not None)
+
+
+STATS_ROLLUP_SECONDS = float(os.getenv("STATS_ROLLUP_SECONDS", "10"))
+
+
+async def rollup_stats_periodically() -> None:
+    """Fold pending user statistics changes into the aggregates every STATS_ROLLUP_SECONDS."""
+    while True:
+        await asyncio.sleep(STATS_ROLLUP_SECONDS)
+        try:
+            database.rollup_stats_bcrypt()
+        except Exception as error:
+            print(f"Statistics rollup failed: {error!r}")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    database.create_table_bcrypt()
+    database.create_stats_bcrypt()
+    database.create_search_indexes_bcrypt()
+    api_key_auth.create_table()
+    watchdog.start()
+    rollup = asyncio.create_task(rollup_stats_periodically())
+    try:
+        yield
+    finally:
+        rollup.cancel()
+        watchdog.stop()
+
+
+app: FastAPI = FastAPI(lifespan=lifespan) # fastapi dev /Users/Daniil/Desktop/Project/app/main.py --port 9999
+admission = AdmissionController(
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT", "100")),
+    deadline=float(os.getenv("REQUEST_DEADLINE_MS", "5000")) / 1000,
+)
+app.add_middleware(AdmissionMiddleware, controller=admission, exempt_prefixes=("/admin/",))
+
+
+@app.exception_handler(DeadlineExceeded)
+async def deadline_exceeded_handler(request: Request, error: DeadlineExceeded):
+    return JSONResponse({"detail": str(error)}, status_code=503, headers={"Retry-After": "1"})
 
 
 @app.get("/data", response_model=list[PersonBcrypt])
-async def get_data_to_user(number: int = 100, descending: bool = False):
+async def get_data_to_user(number: int = 100, descending: bool = False, client: ApiClient | None = Depends(api_key_auth.optional_scopes("users:read"))):
     return database.get_data_bcrypt(number=number, descending=descending)
 
 
+@app.get("/data/search", response_model=list[PersonResponse])
+async def search_data(q: str, limit: int = 20, current_user: TokenData = Depends(api_key_auth.user_or_scopes("search:read"))):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Search query cannot be empty")
+    
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+    
+    key = (q.strip().lower(), limit)
+    results: list[dict] | None = search_cache.get(key)
+    if results is None:
+        results = database.search_data_bcrypt(query=q, limit=limit)
+        search_cache.set(key, results)
+    return results
+
+
+@app.get("/stats", response_model=PersonStats)
+async def get_user_stats(age_bucket: int = 10, days: int = 30, current_user: TokenData = Depends(api_key_auth.user_or_scopes("stats:read"))):
+    if age_bucket < 1 or days < 1:
+        raise HTTPException(status_code=400, detail="age_bucket and days must be positive")
+    return database.get_stats_bcrypt(age_bucket=age_bucket, days=days)
+
+
 @app.post("/signing", response_model=PersonBcrypt, status_code=201)    
 async def insert_data_to_db(data: PersonCreate):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
     age = PersonCreate.calculate_age(birth_date=data.birth_date)
     password_hashed = PersonCreate.password_bcrypt_hash(data.password)
     
-    with database.connection.cursor() as cur:
-        cur.execute(t"INSERT INTO test_bcrypt  \
+    created_person: dict = database.execute_for(data.email, t"INSERT INTO test_bcrypt  \
                     (first_name, last_name, gender, age, \
                     birth_date, email, hash_password) \
                     VALUES \
                     ({data.first_name}, {data.last_name}, {data.gender}, {age}, \
                     {data.birth_date}, {data.email}, {password_hashed}) \
-                    RETURNING *")
-        database.connection.commit()
-        created_person: dict = cur.fetchone() # type: ignore
-        return created_person
+                    RETURNING *", commit=True) # type: ignore
+    return created_person
 
 @app.put("/data/{email}", response_model=PersonBcrypt)    
 async def update_data_in_db(email: str, password: str, data: PersonUpdate):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
+    hashed_password: str | None = database.get_hashed_password(email=email)
+    if hashed_password is None:
+        raise HTTPException(status_code=404, detail="Person not found")
     
-    with database.connection.cursor() as cur:
-        cur.execute(t"SELECT hash_password FROM test_bcrypt WHERE email = {email}")
-        private: dict | None = cur.fetchone() 
-        
-        if private is None:
-            raise HTTPException(status_code=404, detail="Person not found")
-        
-        hashed_password: str = private['hash_password']
-        password_check: bool = PersonCreate.password_bcrypt_check(
-            password,
-            hashed_password
+    password_check: bool = PersonCreate.password_bcrypt_check(
+        password,
+        hashed_password
+    )
+    if not password_check:
+        raise HTTPException(status_code=403, detail="Incorrect password or email")
+    
+    age = PersonCreate.calculate_age(birth_date=data.birth_date) if data.birth_date is not None else None
+    new_password_encrypted: str | None = None
+    if data.password is not None:
+        new_password_encrypted = PersonCreate.password_bcrypt_hash(
+            data.password,
         )
-        if not password_check:
-            raise HTTPException(status_code=403, detail="Incorrect password or email")
-        
-        age = PersonCreate.calculate_age(birth_date=data.birth_date) if data.birth_date is not None else None
-        new_password_encrypted: str | None = None
-        if data.password is not None:
-            new_password_encrypted = PersonCreate.password_bcrypt_hash(
-                data.password,
-            )
-        else:
-            new_password_encrypted= PersonCreate.password_bcrypt_hash(password) 
-                           
-        cur.execute(t"UPDATE test_bcrypt SET first_name = COALESCE({data.first_name}, first_name), \
+    else:
+        new_password_encrypted= PersonCreate.password_bcrypt_hash(password) 
+                       
+    updated_person: dict | None = database.execute_for(email, t"UPDATE test_bcrypt SET first_name = COALESCE({data.first_name}, first_name), \
                     last_name = COALESCE({data.last_name}, last_name), \
                     gender = COALESCE({data.gender}, gender), \
                     age = COALESCE({age}, age), \
                     birth_date = COALESCE({data.birth_date}, birth_date), \
-                    hash_password = COALESCE({new_password_encrypted}, hash_password) \
+                    hash_password = COALESCE({new_password_encrypted}, hash_password), \
+                    updated_at = now(), \
+                    version = version + 1 \
                     WHERE email = {email} \
-                    RETURNING *")
-        database.connection.commit()
-        updated_person: dict = cur.fetchone() # type: ignore
-        return updated_person
+                    RETURNING *", commit=True)
+    if updated_person is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    return updated_person
     
 @app.delete("/data/{email}", response_model=PersonBcrypt)    
 async def delete_data_from_db(email: str, password: str):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
     encrypted_password: str | None = database.get_hashed_password(email=email)
     if encrypted_password is None:
         raise HTTPException(status_code=404, detail="Person not found")
@@ -99,142 +216,188 @@ async def delete_data_from_db(email: str, password: str):
     if not password_check:
         raise HTTPException(status_code=403, detail="Incorrect password or email")
 
-    with database.connection.cursor() as cur:
-        cur.execute(t"DELETE FROM test_bcrypt WHERE email = {email} RETURNING *")
-        database.connection.commit()
-        deleted_person: dict | None = cur.fetchone() 
-        
-        if deleted_person is None:
-            raise HTTPException(status_code=404, detail="Person not found")
-        
-        return deleted_person
+    deleted_person: dict | None = database.execute_for(email, t"DELETE FROM test_bcrypt WHERE email = {email} RETURNING *", commit=True)
+    if deleted_person is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    api_key_auth.revoke_owner_keys(owner_email=email)
+    return deleted_person
     
 @app.get("/data/{email}", response_model=PersonBcrypt)
-async def get_person_by_email(email: str):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
+async def get_person_by_email(email: str, response: Response, if_none_match: str | None = Header(default=None)):
+    current: str | None = current_etag(email) if if_none_match is not None else None
+    if etag_matches(if_none_match, current):
+        return Response(status_code=304, headers={"ETag": current}) # type: ignore
     
-    with database.connection.cursor() as cur:
-        cur.execute(t"SELECT * FROM test_bcrypt WHERE email = {email}")
-        person: dict | None = cur.fetchone() 
-        
-        if person is None:
-            raise HTTPException(status_code=404, detail="Person not found")
-        
-        return person
+    person: dict | None = database.get_single_data_bcrypt(email)
+    if person is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    etag = person_etag(person)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return person
     
 @app.get("/login/{email}", response_model=dict | None)
 async def login(email: str, password: str):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
-    hashed_password: str | None = database.get_hashed_password(email=email)
-    if hashed_password is None:
+    password_check: bool | None = await check_credentials(email, password)
+    if password_check is None:
         raise HTTPException(status_code=404, detail="Person not found")
         
-    password_check: bool = PersonCreate.password_bcrypt_check(
-        password,
-        hashed_password
-    )
     if not password_check:
         raise HTTPException(status_code=403, detail="Incorrect password or email")
     return {"message": "Login successful"}
 
 @app.post("/token", response_model=PersonTokenResponse)    
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends()):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
-    with database.connection.cursor() as cur:
-        cur.execute(t"SELECT email, hash_password FROM test_bcrypt WHERE email = {form_data.username}")
-        user: dict | None = cur.fetchone() 
-        
-        if user is None or not PersonCreate.password_bcrypt_check(form_data.password, user['hash_password']):
-            raise HTTPException(status_code=404, detail="Incorrect email or password")
+    async def issue_token() -> tuple[bool | None, dict[str, str] | None]:
+        password_check: bool | None = await check_credentials(form_data.username, form_data.password)
+        if not password_check:
+            return password_check, None
         
         token_data = {
-            "email": user["email"],
+            "email": form_data.username,
         }
         access_token_expires = 30 # minutes
         access_token = auth_token.create_access_token(
             data=token_data,
             expires_delta=access_token_expires
         )
-        return {"access_token": access_token, "token_type": "bearer"}
+        return password_check, {"access_token": access_token, "token_type": "bearer"}
     
-@app.get("/data_token/me", response_model=PersonBcrypt)
-async def read_users_me(current_user: TokenData = Depends(auth_token.get_current_active_user)):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
+    _, token = await token_flights.do(
+        credential_key(form_data.username, form_data.password),
+        issue_token,
+        saves=lambda issued: issued[0] is not None
+    )
+    if token is None:
+        raise HTTPException(status_code=404, detail="Incorrect email or password")
+    return token
     
+@app.get("/data_token/me", response_model=PersonBcrypt)
+async def read_users_me(response: Response, if_none_match: str | None = Header(default=None), current_user: TokenData = Depends(auth_token.get_current_active_user)):
     if current_user.email is None:
         raise HTTPException(status_code=400, detail="Email not found in token.")
     
-    with database.connection.cursor() as cur:
-        cur.execute(t"SELECT * FROM test_bcrypt WHERE email = {current_user.email}")
-        user: dict | None = cur.fetchone() 
-        
-        if user is None:
-            raise HTTPException(status_code=404, detail="User not found.")
-        
-        return user
+    current: str | None = current_etag(current_user.email) if if_none_match is not None else None
+    if etag_matches(if_none_match, current):
+        return Response(status_code=304, headers={"ETag": current}) # type: ignore
+    
+    user: dict | None = database.get_single_data_bcrypt(current_user.email)
+    if user is None:
+        raise HTTPException(status_code=404, detail="User not found.")
+    
+    etag = person_etag(user)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return user
 
 @app.delete("/data_token/{email}", response_model=PersonBcrypt)    
 async def delete_data_from_db_with_token(email: str, current_user: TokenData = Depends(auth_token.get_current_active_user)):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
     if current_user.email is None:
         raise HTTPException(status_code=400, detail="Email not found in token.")
     
     if current_user.email != email:
         raise HTTPException(status_code=403, detail="You can only delete your own account")
-
-    with database.connection.cursor() as cur:
-        cur.execute(t"DELETE FROM test_bcrypt WHERE email = {current_user.email} RETURNING *")
-        database.connection.commit()
-        deleted_person: dict | None = cur.fetchone() 
-        
-        if deleted_person is None:
-            raise HTTPException(status_code=404, detail="Person not found")
-        
-        return deleted_person
+    
+    deleted_person: dict | None = database.execute_for(email, t"DELETE FROM test_bcrypt WHERE email = {current_user.email} RETURNING *", commit=True)
+    if deleted_person is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    api_key_auth.revoke_owner_keys(owner_email=email)
+    return deleted_person
     
 @app.put("/data_token/{email}", response_model=PersonBcrypt)    
 async def update_data_in_db_with_token(email: str, data: PersonUpdate, current_user: TokenData = Depends(auth_token.get_current_active_user)):
-    if database.connection is None:
-        raise ValueError("No database connection. Call connect() first.")
-    
     if current_user.email is None:
         raise HTTPException(status_code=400, detail="Email not found in token.")
     
     if current_user.email != email:
         raise HTTPException(status_code=403, detail="You can only delete your own account")
-    with database.connection.cursor() as cur:
-        cur.execute(t"SELECT hash_password FROM test_bcrypt WHERE email = {current_user.email}")
-        private: dict | None = cur.fetchone() 
-        
-        if private is None:
-            raise HTTPException(status_code=404, detail="Person not found")
-        database.connection.commit()
-        
-        hashed_password: str = private['hash_password']
-        new_password_encrypted: str | None = None
-        if data.password is not None:
-            new_password_encrypted = PersonCreate.password_bcrypt_hash(
-                data.password
-            )
-        else:
-            new_password_encrypted= hashed_password
-        age = PersonCreate.calculate_age(birth_date=data.birth_date) if data.birth_date is not None else None
-        cur.execute(t"UPDATE test_bcrypt SET first_name = COALESCE({data.first_name}, first_name), \
+    
+    hashed_password: str | None = database.get_hashed_password(email=current_user.email)
+    if hashed_password is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    new_password_encrypted: str | None = None
+    if data.password is not None:
+        new_password_encrypted = PersonCreate.password_bcrypt_hash(
+            data.password
+        )
+    else:
+        new_password_encrypted= hashed_password
+    age = PersonCreate.calculate_age(birth_date=data.birth_date) if data.birth_date is not None else None
+    updated_person: dict | None = database.execute_for(email, t"UPDATE test_bcrypt SET first_name = COALESCE({data.first_name}, first_name), \
                     last_name = COALESCE({data.last_name}, last_name), \
                     gender = COALESCE({data.gender}, gender), \
                     age = COALESCE({age}, age), \
                     birth_date = COALESCE({data.birth_date}, birth_date), \
-                    hash_password = COALESCE({new_password_encrypted}, hash_password) \
+                    hash_password = COALESCE({new_password_encrypted}, hash_password), \
+                    updated_at = now(), \
+                    version = version + 1 \
                     WHERE email = {email} \
-                    RETURNING *")
-        database.connection.commit()
-        updated_person: dict = cur.fetchone() # type: ignore
-        return updated_person
\ No newline at end of file
+                    RETURNING *", commit=True)
+    if updated_person is None:
+        raise HTTPException(status_code=404, detail="Person not found")
+    
+    return updated_person
+
+@app.post("/api_keys", response_model=ApiKeyCreated, status_code=201)
+async def create_api_key(data: ApiKeyCreate, current_user: TokenData = Depends(auth_token.get_current_active_user)):
+    if current_user.email is None:
+        raise HTTPException(status_code=400, detail="Email not found in token.")
+    
+    return api_key_auth.issue_key(
+        owner_email=current_user.email,
+        name=data.name,
+        scopes=data.scopes,
+        expires_in_days=data.expires_in_days
+    )
+
+@app.get("/api_keys", response_model=list[ApiKeyResponse])
+async def list_api_keys(current_user: TokenData = Depends(auth_token.get_current_active_user)):
+    if current_user.email is None:
+        raise HTTPException(status_code=400, detail="Email not found in token.")
+    
+    return api_key_auth.list_keys(owner_email=current_user.email)
+
+@app.delete("/api_keys/{key_id}", response_model=ApiKeyResponse)
+async def revoke_api_key(key_id: int, current_user: TokenData = Depends(auth_token.get_current_active_user)):
+    if current_user.email is None:
+        raise HTTPException(status_code=400, detail="Email not found in token.")
+    
+    revoked: dict | None = api_key_auth.revoke_key(owner_email=current_user.email, key_id=key_id)
+    if revoked is None:
+        raise HTTPException(status_code=404, detail="API key not found")
+    return revoked
+
+@app.get("/api_keys/me", response_model=ApiClient)
+async def read_api_client(client: ApiClient = Depends(api_key_auth.get_current_client)):
+    return client
+
+@app.post("/admin/profile", response_class=PlainTextResponse)
+async def profile_event_loop(seconds: float = 10, current_user: TokenData = Depends(auth_token.get_current_admin_user)):
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be between 0 and {MAX_PROFILE_SECONDS}")
+    
+    if watchdog.loop_thread_id is None:
+        raise HTTPException(status_code=503, detail="Event loop watchdog is not running")
+    
+    try:
+        return await asyncio.to_thread(profiler.profile, watchdog.loop_thread_id, seconds)
+    except RuntimeError as error:
+        raise HTTPException(status_code=409, detail=str(error))
+
+@app.get("/admin/load", response_model=dict[str, float])
+async def get_load_metrics(current_user: TokenData = Depends(auth_token.get_current_admin_user)):
+    return admission.metrics()
+
+@app.get("/admin/single_flight", response_model=dict[str, dict[str, int]])
+async def get_single_flight_metrics(current_user: TokenData = Depends(auth_token.get_current_admin_user)):
+    return {
+        "credentials": credential_flights.metrics(),
+        "tokens": token_flights.metrics(),
+        "bcrypt": {"runs_saved": credential_flights.saved + token_flights.saved},
+    }
@@ -1,20 +1,29 @@
 from cryptography.fernet import Fernet
 import bcrypt
 
+from app.load_control import check_deadline
+
 
 class PasswordBcrypt:
     
     @staticmethod
-    def hash_password(plain_password: str) -> str:
+    def hash_password(plain_password: str, rounds: int = 12) -> str:
         """Hash a plaintext password using bcrypt.
 
         Arguments:
             plain_password -- The plaintext password to hash.
 
+        Keyword Arguments:
+            rounds -- The bcrypt cost factor (default 12).
+
+        Raises:
+            DeadlineExceeded: If the current request's deadline has passed.
+
         Returns:
             The hashed password as a string.
         """        
-        return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
+        check_deadline()
+        return bcrypt.hashpw(plain_password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
     
     @staticmethod
     def check_password(plain_password: str, hashed_password: str) -> bool:
@@ -23,9 +32,12 @@ class PasswordBcrypt:
         Arguments:
             plain_password -- The plaintext password to check.
             hashed_password -- The hashed password to compare against.
+        Raises:
+            DeadlineExceeded: If the current request's deadline has passed.
         Returns:
             True if the passwords match, False otherwise.
         """        
+        check_deadline()
         return bcrypt.checkpw(plain_password.encode("utf-8"), hashed_password.encode("utf-8"))
 
 
@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime
 from pydantic import BaseModel, Field, field_validator
 from app.password_handler import PasswordFernet, PasswordBcrypt
 
@@ -85,6 +85,55 @@ class TokenData(BaseModel):
     email: str | None = Field(default=None, description="The email address extracted from the token.")
     
 
+API_KEY_SCOPES = frozenset({"users:read", "search:read", "stats:read"})
+
+
+class ApiKeyCreate(BaseModel):
+    """Schema for issuing a new API key."""
+    name: str = Field(..., min_length=1, max_length=100, description="A label identifying the client using the key.")
+    scopes: list[str] = Field(default_factory=list, description=f"The scopes granted to the key, out of {', '.join(sorted(API_KEY_SCOPES))}.")
+    expires_in_days: int | None = Field(default=None, gt=0, description="The number of days until the key expires, or None for no expiry.")
+
+    @field_validator("scopes")
+    @classmethod
+    def known_scopes(cls, scopes: list[str]) -> list[str]:
+        """Reject scopes a key cannot be granted and drop repeated ones."""
+        unknown = sorted(set(scopes) - API_KEY_SCOPES)
+        if unknown:
+            raise ValueError(f"Unknown scopes: {', '.join(unknown)}")
+        return list(dict.fromkeys(scopes))
+
+
+class ApiKeyResponse(BaseModel):
+    """Schema for API key metadata returned from API."""
+    id: int = Field(..., description="The unique identifier of the key.")
+    name: str = Field(..., description="A label identifying the client using the key.")
+    scopes: list[str] = Field(..., description="The scopes granted to the key.")
+    created_at: datetime = Field(..., description="When the key was issued.")
+    expires_at: datetime | None = Field(default=None, description="When the key expires.")
+    revoked_at: datetime | None = Field(default=None, description="When the key was revoked.")
+
+
+class ApiKeyCreated(ApiKeyResponse):
+    """Schema for a newly issued API key, the only time the key itself is returned."""
+    key: str = Field(..., description="The API key. It cannot be retrieved again.")
+
+
+class ApiClient(BaseModel):
+    """Schema for the machine client authenticated by an API key."""
+    key_id: int = Field(..., description="The unique identifier of the key.")
+    owner_email: str = Field(..., description="The email address of the person who issued the key.")
+    scopes: list[str] = Field(..., description="The scopes granted to the key.")
+
+
+class PersonStats(BaseModel):
+    """Schema for aggregated user statistics."""
+    total: int = Field(..., description="The total number of users.")
+    by_gender: dict[str, int] = Field(..., description="The number of users per gender.")
+    age_histogram: dict[int, int] = Field(..., description="The number of users per age bucket, keyed by the bucket's lower bound.")
+    signups_per_day: dict[date, int] = Field(..., description="The number of signups per day.")
+    
+
 class Person():
     """A class to represent a person with personal details.
 
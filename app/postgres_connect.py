@@ -1,11 +1,59 @@
 import psycopg
 from psycopg.rows import dict_row, DictRow       
+from psycopg.errors import QueryCanceled
+from psycopg.pq import TransactionStatus
 from dotenv import load_dotenv
 from os import getenv
 from typing import Any
+from datetime import date
+from string.templatelib import Template
 
 from app.person import Person
 from app.password_handler import PasswordFernet
+from app.load_control import DeadlineExceeded, check_deadline, remaining_seconds, request_deadline
+
+
+# Ids step by this much on every database, from a different start on each shard,
+# so they stay unique across shards and when rows move between them. It is the
+# most shards a layout can have.
+ID_STRIDE = 1024
+# How long a migration waits for an exclusive lock before giving up.
+MIGRATION_LOCK_TIMEOUT = "5s"
+
+
+class DeadlineConnection(psycopg.Connection[DictRow]):
+    """Connection that remembers which deadline its open transaction is bounded by."""
+
+    applied_deadline: float | None = None
+
+
+class DeadlineCursor(psycopg.Cursor[DictRow]):
+    """Cursor that bounds every query by the current request's deadline.
+
+    The remaining budget is applied as a transaction-local statement_timeout
+    once per transaction, so Postgres cancels work the client has given up on.
+    It is applied again only when a query runs for another deadline inside the
+    same transaction, and reset to 0 for queries without one.
+    """
+
+    def execute(self, query, params=None, **kwargs): # type: ignore
+        check_deadline()
+        deadline = request_deadline.get()
+        connection: DeadlineConnection = self.connection # type: ignore
+        if connection.info.transaction_status == TransactionStatus.IDLE:
+            connection.applied_deadline = None
+        try:
+            if deadline != connection.applied_deadline:
+                remaining = remaining_seconds()
+                timeout = 0 if remaining is None else max(int(remaining * 1000), 1)
+                super().execute("SELECT set_config('statement_timeout', %s, true)", [str(timeout)])
+                connection.applied_deadline = deadline
+            return super().execute(query, params, **kwargs)
+        except QueryCanceled as error:
+            if deadline is None:
+                raise
+            connection.rollback()
+            raise DeadlineExceeded("Request deadline exceeded.") from error
 
 class DBConnect:
     def __init__(self):
@@ -24,7 +72,7 @@ class DBConnect:
         connect_string = f"dbname={self.db_name} user={self.db_user}\
             password={self.db_password} host={self.db_host} port={self.db_port}"
         
-        self.connection = psycopg.connect(connect_string, row_factory=dict_row) # type: ignore
+        self.connection = DeadlineConnection.connect(connect_string, row_factory=dict_row, cursor_factory=DeadlineCursor) # type: ignore
         print("Connection to the database was successful.")
     
     def close(self) -> None:
@@ -171,6 +219,49 @@ class TestDBConnection(DBConnect):
 
 class TestBcryptDBConnection(DBConnect):
     
+    def connection_for(self, email: str | None = None) -> psycopg.Connection[DictRow]:
+        """Return the connection that stores the record for a given email.
+
+        Keyword Arguments:
+            email -- The email of the person whose record is accessed (default None).
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            The connection to run queries for this email on.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        return self.connection
+    
+    @staticmethod
+    def _execute_one(connection: psycopg.Connection[DictRow], query: Template, commit: bool) -> dict[str, Any] | None:
+        with connection.cursor() as cur:
+            cur.execute(query)
+            row: dict[str, Any] | None = cur.fetchone()
+        if commit:
+            connection.commit()
+        return row
+    
+    def execute_for(self, email: str, query: Template, commit: bool = False) -> dict[str, Any] | None:
+        """Run a statement on the record of a given email and return its first row.
+
+        Arguments:
+            email -- The email of the person whose record is accessed.
+            query -- The statement to run, returning at most one row.
+
+        Keyword Arguments:
+            commit -- Whether to commit after the statement (default False).
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            The first row returned by the statement, or None if there is none.
+        """
+        return self._execute_one(self.connection_for(email), query, commit)
+    
     def create_table_bcrypt(self) -> None:
         """Create the test_bcrypt table in the database if it does not exist.
 
@@ -184,16 +275,199 @@ class TestBcryptDBConnection(DBConnect):
             cur.execute(
             """
             CREATE TABLE IF NOT EXISTS test_bcrypt (
-                id SERIAL PRIMARY KEY,
+                id BIGSERIAL PRIMARY KEY,
                 first_name VARCHAR(50) NOT NULL,
                 last_name VARCHAR(50) NOT NULL,
                 gender VARCHAR(30) NOT NULL,
                 age INT NOT NULL,
                 birth_date DATE NOT NULL,
                 email VARCHAR(200) UNIQUE NOT NULL,
-                hash_password TEXT NOT NULL
+                hash_password TEXT NOT NULL,
+                created_at TIMESTAMPTZ DEFAULT now(),
+                updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                version BIGINT NOT NULL DEFAULT 1
             )""")
-            cur.close()
+            # Existing rows have no known signup time, so they keep NULL and only new rows get the default.
+            cur.execute("ALTER TABLE test_bcrypt ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ")
+            cur.execute("ALTER TABLE test_bcrypt ALTER COLUMN created_at SET DEFAULT now()")
+            cur.execute("ALTER TABLE test_bcrypt ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now()")
+            cur.execute("ALTER TABLE test_bcrypt ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 1")
+            cur.execute("CREATE INDEX IF NOT EXISTS test_bcrypt_created_at_email \
+                        ON test_bcrypt (created_at ASC NULLS FIRST, email ASC)")
+        self.connection.commit()
+    
+    def max_id_bcrypt(self) -> int:
+        """Return the highest id in the test_bcrypt table, or 0 if it is empty.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT COALESCE(max(id), 0) AS max_id FROM test_bcrypt")
+            row: dict = cur.fetchone() # type: ignore
+        self.connection.commit()
+        return row['max_id']
+    
+    def configure_ids_bcrypt(self, offset: int, floor: int) -> None:
+        """Make the ids issued by this database unique across shards.
+
+        Ids step by ID_STRIDE from a start above every existing id that is
+        congruent to `offset`. Runs once per database: a sequence already
+        stepping by ID_STRIDE is left alone. Rows that predate the change keep
+        their ids on the first shard and are renumbered the same way on the
+        others, where their ids could repeat those of the first shard.
+
+        The change locks test_bcrypt exclusively and rewrites it, so it is run
+        by app.rebalance rather than at startup, and gives up after
+        MIGRATION_LOCK_TIMEOUT instead of queueing every query behind its lock.
+
+        Arguments:
+            offset -- The position of this database in the shard layout.
+            floor -- The highest id on any shard.
+
+        Raises:
+            ValueError: If no database connection is established or offset is not below ID_STRIDE.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        if not 0 <= offset < ID_STRIDE:
+            raise ValueError(f"A shard layout can have at most {ID_STRIDE} shards.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT increment_by FROM pg_sequences WHERE sequencename = 'test_bcrypt_id_seq'")
+            sequence: dict | None = cur.fetchone()
+            if sequence is None or sequence['increment_by'] == ID_STRIDE:
+                self.connection.commit()
+                return
+            
+            cur.execute(t"SET LOCAL lock_timeout = {MIGRATION_LOCK_TIMEOUT:l}")
+            cur.execute("LOCK TABLE test_bcrypt IN ACCESS EXCLUSIVE MODE")
+            cur.execute("SELECT increment_by FROM pg_sequences WHERE sequencename = 'test_bcrypt_id_seq'")
+            sequence = cur.fetchone()
+            if sequence is not None and sequence['increment_by'] != ID_STRIDE:
+                cur.execute("SELECT COALESCE(max(id), 0) AS max_id FROM test_bcrypt")
+                floor = max(floor, cur.fetchone()['max_id']) # type: ignore
+                start = floor + 1 + (offset - floor - 1) % ID_STRIDE
+                cur.execute("ALTER TABLE test_bcrypt ALTER COLUMN id TYPE BIGINT")
+                cur.execute(t"ALTER SEQUENCE test_bcrypt_id_seq AS BIGINT INCREMENT BY {ID_STRIDE:l}")
+                if offset > 0:
+                    cur.execute(t"UPDATE test_bcrypt SET id = {start} + (id - 1) * {ID_STRIDE}")
+                    cur.execute("SELECT COALESCE(max(id), 0) AS max_id FROM test_bcrypt")
+                    renumbered: int = cur.fetchone()['max_id'] # type: ignore
+                    start = max(start, renumbered + ID_STRIDE)
+                cur.execute(t"SELECT setval('test_bcrypt_id_seq', {start}, false)")
+        self.connection.commit()
+    
+    def create_stats_bcrypt(self) -> None:
+        """Create the aggregate tables behind the user statistics and the trigger that feeds them.
+
+        Counts are kept per gender, per birth date and per signup day of existing
+        users. Every insert, update and delete of test_bcrypt appends its change to
+        test_bcrypt_stats_delta, so concurrent writes never wait on a shared counter
+        row, and rollup_stats_bcrypt() folds the pending changes into the counts.
+        Users without a known signup time are left out of the signup counts.
+        The aggregates are backfilled from test_bcrypt the first time they are created.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT to_regclass('test_bcrypt_stats_gender') IS NULL AS missing")
+            row: dict[str, Any] = cur.fetchone() # type: ignore
+            backfill: bool = row['missing']
+            cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS test_bcrypt_stats_gender (
+                gender VARCHAR(30) PRIMARY KEY,
+                count BIGINT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS test_bcrypt_stats_birth (
+                birth_date DATE PRIMARY KEY,
+                count BIGINT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS test_bcrypt_stats_signup (
+                day DATE PRIMARY KEY,
+                count BIGINT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS test_bcrypt_stats_delta (
+                gender VARCHAR(30) NOT NULL,
+                birth_date DATE NOT NULL,
+                day DATE,
+                delta INT NOT NULL
+            );
+            CREATE OR REPLACE FUNCTION test_bcrypt_stats_trigger() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    INSERT INTO test_bcrypt_stats_delta VALUES (NEW.gender, NEW.birth_date, NEW.created_at::date, 1);
+                ELSIF TG_OP = 'UPDATE' THEN
+                    IF NEW.gender IS DISTINCT FROM OLD.gender OR NEW.birth_date IS DISTINCT FROM OLD.birth_date THEN
+                        INSERT INTO test_bcrypt_stats_delta VALUES
+                            (OLD.gender, OLD.birth_date, NULL, -1),
+                            (NEW.gender, NEW.birth_date, NULL, 1);
+                    END IF;
+                ELSIF TG_OP = 'DELETE' THEN
+                    INSERT INTO test_bcrypt_stats_delta VALUES (OLD.gender, OLD.birth_date, OLD.created_at::date, -1);
+                END IF;
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+            CREATE OR REPLACE TRIGGER test_bcrypt_stats
+                AFTER INSERT OR UPDATE OR DELETE ON test_bcrypt
+                FOR EACH ROW EXECUTE FUNCTION test_bcrypt_stats_trigger();
+            DROP FUNCTION IF EXISTS test_bcrypt_stats_apply(VARCHAR, DATE, BIGINT);
+            """)
+            if backfill:
+                cur.execute("LOCK TABLE test_bcrypt IN SHARE ROW EXCLUSIVE MODE")
+                cur.execute("""
+                    INSERT INTO test_bcrypt_stats_gender (gender, count)
+                        SELECT gender, count(*) FROM test_bcrypt GROUP BY gender;
+                    INSERT INTO test_bcrypt_stats_birth (birth_date, count)
+                        SELECT birth_date, count(*) FROM test_bcrypt GROUP BY birth_date;
+                    INSERT INTO test_bcrypt_stats_signup (day, count)
+                        SELECT created_at::date, count(*) FROM test_bcrypt
+                        WHERE created_at IS NOT NULL GROUP BY created_at::date;
+                    """)
+        self.connection.commit()
+    
+    def rollup_stats_bcrypt(self) -> None:
+        """Fold the pending changes in test_bcrypt_stats_delta into the aggregate tables.
+
+        Only one rollup runs at a time, a call made while another is running returns
+        immediately. Changes appended while a rollup runs are left for the next one.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(hashtext('test_bcrypt_stats_rollup')) AS locked")
+            row: dict[str, Any] = cur.fetchone() # type: ignore
+            if row['locked']:
+                cur.execute("""
+                    WITH moved AS (
+                        DELETE FROM test_bcrypt_stats_delta RETURNING *
+                    ), genders AS (
+                        INSERT INTO test_bcrypt_stats_gender AS s (gender, count)
+                            SELECT gender, sum(delta) FROM moved GROUP BY gender
+                            ON CONFLICT (gender) DO UPDATE SET count = s.count + EXCLUDED.count
+                    ), births AS (
+                        INSERT INTO test_bcrypt_stats_birth AS s (birth_date, count)
+                            SELECT birth_date, sum(delta) FROM moved GROUP BY birth_date
+                            ON CONFLICT (birth_date) DO UPDATE SET count = s.count + EXCLUDED.count
+                    )
+                    INSERT INTO test_bcrypt_stats_signup AS s (day, count)
+                        SELECT day, sum(delta) FROM moved WHERE day IS NOT NULL GROUP BY day
+                        ON CONFLICT (day) DO UPDATE SET count = s.count + EXCLUDED.count
+                    """)
+        self.connection.commit()
             
     def insert_data_bcrypt(self, person_data: dict[str, Any]) -> None:
         """Insert a new record into the test_bcrypt table.
@@ -216,8 +490,114 @@ class TestBcryptDBConnection(DBConnect):
                         {person_data['birth_date']}, {person_data['email']}, {person_data['hash_password']})")
         self.connection.commit()
     
+    def copy_data_bcrypt(self, rows: list[dict[str, Any]]) -> None:
+        """Bulk load records into the test_bcrypt table with COPY.
+
+        Arguments:
+            rows -- Dictionaries with first_name, last_name, gender, age,
+                birth_date, email, hash_password and created_at keys.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        columns = ("first_name", "last_name", "gender", "age", "birth_date", "email", "hash_password", "created_at")
+        with self.connection.cursor() as cur:
+            with cur.copy("COPY test_bcrypt (first_name, last_name, gender, age, \
+                          birth_date, email, hash_password, created_at) FROM STDIN") as copy:
+                for row in rows:
+                    copy.write_row(tuple(row[column] for column in columns))
+        self.connection.commit()
+    
+    def create_search_indexes_bcrypt(self) -> None:
+        """Create the indexes used by search_data_bcrypt on first_name, last_name and email.
+
+        Btree text_pattern_ops indexes serve prefix matches on each field and a
+        trigram GiST index over all three serves substring matches in similarity
+        order. On a large existing table, create them beforehand with
+        CREATE INDEX CONCURRENTLY to avoid blocking writes.
+
+        Raises:
+            ValueError: If no database connection is established.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute(
+            """
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            DROP INDEX IF EXISTS test_bcrypt_first_name_trgm;
+            DROP INDEX IF EXISTS test_bcrypt_last_name_trgm;
+            DROP INDEX IF EXISTS test_bcrypt_email_trgm;
+            CREATE INDEX IF NOT EXISTS test_bcrypt_search_trgm ON test_bcrypt
+                USING GIST (lower(first_name || ' ' || last_name || ' ' || email) gist_trgm_ops);
+            CREATE INDEX IF NOT EXISTS test_bcrypt_first_name_prefix ON test_bcrypt (lower(first_name) text_pattern_ops);
+            CREATE INDEX IF NOT EXISTS test_bcrypt_last_name_prefix ON test_bcrypt (lower(last_name) text_pattern_ops);
+            CREATE INDEX IF NOT EXISTS test_bcrypt_email_prefix ON test_bcrypt (lower(email) text_pattern_ops);
+            """)
+        self.connection.commit()
+    
+    def search_data_bcrypt(self, query: str, limit: int = 20) -> list[dict[str, Any]]:
+        """Search the test_bcrypt table by partial first name, last name or email.
+
+        Records with a field starting with the query come first, up to `limit` per
+        field from the prefix indexes. Queries of three or more characters then
+        fill the remaining places with records containing the query anywhere,
+        nearest first by trigram word similarity through the GiST index.
+
+        Arguments:
+            query -- The text to search for, case insensitive.
+
+        Keyword Arguments:
+            limit -- The maximum number of records to return (default 20).
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            A list of dictionaries representing the best matching records,
+            with their prefix_match and similarity ranking columns.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        text = query.strip().lower()
+        escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        prefix = f"{escaped}%"
+        
+        with self.connection.cursor() as cur:
+            cur.execute(t"SELECT *, true AS prefix_match, \
+                        word_similarity({text}, lower(first_name || ' ' || last_name || ' ' || email)) AS similarity \
+                        FROM ( \
+                            (SELECT * FROM test_bcrypt WHERE lower(email) LIKE {prefix} LIMIT {limit}) \
+                            UNION (SELECT * FROM test_bcrypt WHERE lower(first_name) LIKE {prefix} LIMIT {limit}) \
+                            UNION (SELECT * FROM test_bcrypt WHERE lower(last_name) LIKE {prefix} LIMIT {limit}) \
+                        ) AS matches \
+                        ORDER BY similarity DESC, email ASC \
+                        LIMIT {limit}")
+            rows: list[dict] = cur.fetchall()
+            
+            if len(text) >= 3 and len(rows) < limit:
+                pattern = f"%{escaped}%"
+                found = [row['email'] for row in rows]
+                cur.execute(t"SELECT *, false AS prefix_match, \
+                            1 - ({text} <<-> lower(first_name || ' ' || last_name || ' ' || email)) AS similarity \
+                            FROM test_bcrypt \
+                            WHERE lower(first_name || ' ' || last_name || ' ' || email) LIKE {pattern} \
+                            AND email <> ALL({found}::text[]) \
+                            ORDER BY {text} <<-> lower(first_name || ' ' || last_name || ' ' || email) \
+                            LIMIT {limit - len(rows)}")
+                rows += cur.fetchall()
+        self.connection.commit()
+        return rows
+    
     def get_data_bcrypt(self, number: int = 100, descending: bool = False) -> list[dict[str, Any]]:
-        """Retrieve a specified number of records from the test_bcrypt table.
+        """Retrieve a specified number of records from the test_bcrypt table in signup order.
+
+        Records with an unknown signup time come first, ties are ordered by email.
 
         Keyword Arguments:
             number -- The number of records to retrieve 
@@ -234,12 +614,12 @@ class TestBcryptDBConnection(DBConnect):
         
         if descending == False:
             with self.connection.cursor() as cur:
-                cur.execute(t"SELECT * FROM test_bcrypt ORDER BY id ASC LIMIT {number}")
+                cur.execute(t"SELECT * FROM test_bcrypt ORDER BY created_at ASC NULLS FIRST, email ASC LIMIT {number}")
                 rows: list[dict] = cur.fetchall() 
                 return rows
         else:
             with self.connection.cursor() as cur:
-                cur.execute(t"SELECT * FROM test_bcrypt ORDER BY id DESC LIMIT {number}")
+                cur.execute(t"SELECT * FROM test_bcrypt ORDER BY created_at DESC NULLS LAST, email DESC LIMIT {number}")
                 rows: list[dict] = cur.fetchall() 
                 return rows
             
@@ -286,4 +666,44 @@ class TestBcryptDBConnection(DBConnect):
             row: dict[str, Any] | None = cur.fetchone() 
             if row is None:
                 return None
-            return row['hash_password']
\ No newline at end of file
+            return row['hash_password']
+        
+    def get_stats_bcrypt(self, age_bucket: int = 10, days: int = 30) -> dict[str, Any]:
+        """Retrieve user statistics from the precomputed aggregates.
+
+        Changes made since the last rollup_stats_bcrypt() are not counted yet.
+        Ages are derived from birth dates at query time, so they never go stale,
+        and bucketed in the database, so only genders, buckets and days are
+        returned, never one row per user or per birth date.
+
+        Keyword Arguments:
+            age_bucket -- The width in years of each age histogram bucket (default 10).
+            days -- The number of most recent days of signups to return (default 30).
+
+        Raises:
+            ValueError: If no database connection is established.
+
+        Returns:
+            A dictionary with total, by_gender, age_histogram and signups_per_day.
+        """
+        if self.connection is None:
+            raise ValueError("No database connection. Call connect() first.")
+        
+        with self.connection.cursor() as cur:
+            cur.execute("SELECT gender, count FROM test_bcrypt_stats_gender WHERE count > 0")
+            by_gender: dict[str, int] = {row['gender']: row['count'] for row in cur.fetchall()}
+            cur.execute(t"SELECT date_part('year', age(current_date, birth_date))::int / {age_bucket}::int * {age_bucket}::int AS bucket, \
+                        sum(count)::bigint AS count \
+                        FROM test_bcrypt_stats_birth WHERE count > 0 GROUP BY bucket ORDER BY bucket ASC")
+            age_histogram: dict[int, int] = {row['bucket']: row['count'] for row in cur.fetchall()}
+            cur.execute(t"SELECT day, count FROM test_bcrypt_stats_signup \
+                        WHERE day > current_date - {days}::int ORDER BY day ASC")
+            signups_per_day: dict[date, int] = {row['day']: row['count'] for row in cur.fetchall()}
+        self.connection.commit()
+        
+        return {
+            "total": sum(by_gender.values()),
+            "by_gender": by_gender,
+            "age_histogram": dict(sorted(age_histogram.items())),
+            "signups_per_day": signups_per_day,
+        }
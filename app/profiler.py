@@ -0,0 +1,123 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from types import FrameType
+
+
+class SamplingProfiler:
+    """Low-overhead sampling profiler for a single thread.
+
+    Stacks are sampled from a background thread with sys._current_frames(),
+    so the profiled thread is never paused or instrumented. The result is
+    rendered in the folded format understood by flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self._lock.locked()
+
+    @staticmethod
+    def _fold(frame: FrameType | None) -> str:
+        """Collapse a frame chain into a root-first, semicolon separated stack."""
+        names: list[str] = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def profile(self, thread_id: int, seconds: float) -> str:
+        """Sample the stack of a thread for a number of seconds.
+
+        This call blocks, run it in a worker thread when profiling the event loop.
+
+        Arguments:
+            thread_id -- The ident of the thread to sample.
+            seconds -- How long to sample for.
+
+        Raises:
+            RuntimeError: If a profiling session is already running.
+
+        Returns:
+            The collected samples in folded stack format, one stack per line.
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profiling session is already running.")
+        try:
+            samples: Counter[str] = Counter()
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is not None:
+                    samples[self._fold(frame)] += 1
+                time.sleep(self.interval)
+            return "\n".join(f"{stack} {count}" for stack, count in samples.most_common())
+        finally:
+            self._lock.release()
+
+
+class LoopWatchdog:
+    """Detect coroutines that block the event loop.
+
+    A heartbeat task on the loop records when it last ran. A separate thread
+    checks that heartbeat and, once it is older than the threshold, prints the
+    stack of the loop thread so the blocking call can be identified.
+    """
+
+    def __init__(self, threshold: float = 0.1, interval: float = 0.02) -> None:
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls: int = 0
+        self._heartbeat: float = time.monotonic()
+        self._loop_thread_id: int | None = None
+        self._task: asyncio.Task | None = None
+        self._thread: threading.Thread | None = None
+        self._stopped = threading.Event()
+
+    @property
+    def loop_thread_id(self) -> int | None:
+        return self._loop_thread_id
+
+    async def _beat(self) -> None:
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self) -> None:
+        reported: float | None = None
+        while not self._stopped.wait(self.interval):
+            heartbeat = self._heartbeat
+            lag = time.monotonic() - heartbeat
+            if lag < self.threshold or reported == heartbeat or self._loop_thread_id is None:
+                continue
+            reported = heartbeat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "<no frame>\n"
+            print(f"Event loop blocked for more than {lag * 1000:.0f} ms:\n{stack}", file=sys.stderr)
+
+    def start(self) -> None:
+        """Start the watchdog. Must be called from the running event loop."""
+        self._loop_thread_id = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.get_running_loop().create_task(self._beat())
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        """Stop the heartbeat task and the watchdog thread."""
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,126 @@
+"""Move test_bcrypt rows between shard layouts while the API keeps serving.
+
+Run the API with SHARD_DBNAMES set to the new layout and SHARD_DBNAMES_PREVIOUS
+set to the old one, then run:
+
+    python -m app.rebalance --from users_0,users_1 --to users_0,users_1,users_2
+
+Before moving rows, each shard of the new layout is switched once to ids that are
+unique across shards, which locks and rewrites its table for a moment. To do only
+that, for example after first splitting a deployment over SHARD_DBNAMES, run:
+
+    python -m app.rebalance --to users_0,users_1 --ids-only
+
+Rows are copied to their new shard before they are deleted from the old one,
+so a record is always found on one of the two layouts. Rows keep their ids,
+which are unique across shards, so their ETags do not change when they move. A single-user statement
+that waited on a moving row and then matched nothing is retried on the row's new
+shard by ShardedBcryptDBConnection.execute_for. Once the run is done,
+unset SHARD_DBNAMES_PREVIOUS.
+"""
+import argparse
+
+from app.sharding import ShardedBcryptDBConnection, parse_shard_names, shard_index
+
+
+COLUMNS = (
+    "id", "first_name", "last_name", "gender", "age", "birth_date",
+    "email", "hash_password", "created_at", "updated_at", "version",
+)
+INSERT_QUERY = (
+    f"INSERT INTO test_bcrypt ({', '.join(COLUMNS)}) "
+    f"VALUES ({', '.join(['%s'] * len(COLUMNS))}) "
+    "ON CONFLICT (email) DO NOTHING"
+)
+
+
+def rebalance(database: ShardedBcryptDBConnection, batch_size: int = 1000, dry_run: bool = False) -> int:
+    """Move every row of the previous layout to its shard in the current layout.
+
+    Each batch is locked on its source shard, copied to its target shards and
+    only then deleted from the source, so concurrent writes to a moving row
+    wait for the batch instead of being lost.
+
+    Arguments:
+        database -- A sharded connection with both current and previous shards connected.
+
+    Keyword Arguments:
+        batch_size -- The number of source rows handled per transaction (default 1000).
+        dry_run -- Only count the rows that would move (default False).
+
+    Returns:
+        The number of rows moved, or that would be moved in a dry run.
+    """
+    moved = 0
+    for source in dict.fromkeys(database.previous_shards):
+        source_connection = source.connection_for()
+        last_id = 0
+        while True:
+            with source_connection.cursor() as cur:
+                cur.execute(t"SELECT * FROM test_bcrypt WHERE id > {last_id} \
+                            ORDER BY id ASC LIMIT {batch_size} FOR UPDATE")
+                rows: list[dict] = cur.fetchall()
+            if not rows:
+                source_connection.commit()
+                break
+            last_id = rows[-1]['id']
+
+            batches: dict[int, list[dict]] = {}
+            for row in rows:
+                target = shard_index(row['email'], len(database.shards))
+                if database.shards[target] is not source:
+                    batches.setdefault(target, []).append(row)
+            moving = [row['email'] for batch in batches.values() for row in batch]
+
+            if dry_run or not moving:
+                source_connection.commit()
+                moved += len(moving)
+                continue
+
+            for target, batch in batches.items():
+                target_connection = database.shards[target].connection_for()
+                with target_connection.cursor() as cur:
+                    cur.executemany(INSERT_QUERY, [tuple(row[column] for column in COLUMNS) for row in batch])
+                target_connection.commit()
+
+            with source_connection.cursor() as cur:
+                cur.execute(t"DELETE FROM test_bcrypt WHERE email = ANY({moving})")
+            source_connection.commit()
+            moved += len(moving)
+            print(f"{source.db_name}: moved {moved} rows so far.")
+    return moved
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move test_bcrypt rows to a new shard layout.")
+    parser.add_argument("--from", dest="source", default="", help="Comma separated shard databases of the old layout.")
+    parser.add_argument("--to", dest="target", required=True, help="Comma separated shard databases of the new layout.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Rows moved per transaction.")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows that would move.")
+    parser.add_argument("--ids-only", action="store_true", help="Only make ids unique across the shards of --to.")
+    args = parser.parse_args()
+    if not args.source and not args.ids_only:
+        parser.error("--from is required unless --ids-only is given")
+
+    database = ShardedBcryptDBConnection(
+        shard_names=parse_shard_names(args.target),
+        previous_shard_names=parse_shard_names(args.source),
+    )
+    database.connect()
+    try:
+        if not args.dry_run:
+            database.create_table_bcrypt()
+            database.configure_shard_ids_bcrypt()
+            if args.ids_only:
+                print("Ids are unique across shards.")
+                return
+            database.create_stats_bcrypt()
+            database.create_search_indexes_bcrypt()
+        moved = rebalance(database, batch_size=args.batch_size, dry_run=args.dry_run)
+        print(f"{'Would move' if args.dry_run else 'Moved'} {moved} rows.")
+    finally:
+        database.close()
+
+
+if __name__ == "__main__":
+    main()
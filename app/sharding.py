@@ -0,0 +1,222 @@
+import hashlib
+import heapq
+from itertools import islice
+import psycopg
+from datetime import datetime, timezone
+from psycopg.rows import DictRow
+from os import getenv
+from string.templatelib import Template
+from typing import Any, Iterable, Iterator
+
+from app.postgres_connect import TestBcryptDBConnection
+
+
+def normalize_email(email: str) -> str:
+    """Normalize an email address before it is used as a shard key."""
+    return email.strip().lower()
+
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Map a 64-bit key to one of `buckets` buckets with jump consistent hashing.
+
+    When the number of buckets grows from n to n + 1, only about 1 / (n + 1)
+    of the keys move, and all of them move to the new bucket.
+    """
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_index(email: str, shard_count: int) -> int:
+    """Return the index of the shard that owns an email."""
+    digest = hashlib.sha256(normalize_email(email).encode("utf-8")).digest()
+    return jump_hash(int.from_bytes(digest[:8], "big"), shard_count)
+
+
+def unique_by_email(rows: Iterable[dict[str, Any]]) -> Iterator[dict[str, Any]]:
+    """Drop repeated records of the same email, keeping the first one."""
+    seen: set[str] = set()
+    for row in rows:
+        if row['email'] not in seen:
+            seen.add(row['email'])
+            yield row
+
+
+def signup_order(row: dict[str, Any]) -> tuple[bool, datetime, str]:
+    """Sort key of the listing order, unknown signup times first, then by email."""
+    return row['created_at'] is not None, row['created_at'] or datetime.min.replace(tzinfo=timezone.utc), row['email']
+
+
+def parse_shard_names(value: str | None) -> list[str]:
+    """Parse a comma separated list of shard database names."""
+    if not value:
+        return []
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+class ShardedBcryptDBConnection(TestBcryptDBConnection):
+    """test_bcrypt spread over several databases by a hash of the email.
+
+    Shards are listed in SHARD_DBNAMES and live on the same host and credentials
+    as DBNAME, which is used as the only shard when SHARD_DBNAMES is not set.
+    Single-user operations go to the owning shard, listings, searches and
+    statistics are gathered from every shard in `read_shards` and merged. `connection` refers to
+    the first shard, which also stores tables that are not keyed by email.
+
+    While app.rebalance moves rows to a new shard layout, SHARD_DBNAMES_PREVIOUS
+    lists the old layout and records not yet moved are looked up there. Old shards
+    that are not part of the new layout are read until the run is done.
+    """
+
+    def __init__(self, shard_names: list[str] | None = None, previous_shard_names: list[str] | None = None):
+        super().__init__()
+        if shard_names is None:
+            shard_names = parse_shard_names(getenv("SHARD_DBNAMES")) or [str(self.db_name)]
+        if previous_shard_names is None:
+            previous_shard_names = parse_shard_names(getenv("SHARD_DBNAMES_PREVIOUS"))
+
+        self._by_name: dict[str, TestBcryptDBConnection] = {}
+        self.shards: list[TestBcryptDBConnection] = [self._shard(name) for name in shard_names]
+        self.previous_shards: list[TestBcryptDBConnection] = [self._shard(name) for name in previous_shard_names]
+        self.read_shards: list[TestBcryptDBConnection] = self.shards \
+            + [shard for shard in dict.fromkeys(self.previous_shards) if shard not in self.shards]
+
+    def _shard(self, name: str) -> TestBcryptDBConnection:
+        if name not in self._by_name:
+            shard = TestBcryptDBConnection()
+            shard.db_name = name
+            self._by_name[name] = shard
+        return self._by_name[name]
+
+    def connect(self) -> None:
+        """Establish a connection to every shard database."""
+        for shard in self._by_name.values():
+            shard.connect()
+        self.connection = self.shards[0].connection
+
+    def close(self) -> None:
+        """Close the connection to every shard database."""
+        for shard in self._by_name.values():
+            shard.close()
+        self.connection = None
+
+    @staticmethod
+    def _exists(shard: TestBcryptDBConnection, email: str) -> bool:
+        with shard.connection_for(email).cursor() as cur:
+            cur.execute(t"SELECT 1 FROM test_bcrypt WHERE email = {email}")
+            return cur.fetchone() is not None
+
+    def shard_for(self, email: str) -> TestBcryptDBConnection:
+        """Return the shard that stores the record for a given email.
+
+        Arguments:
+            email -- The email of the person whose record is accessed.
+
+        Returns:
+            The owning shard under the current layout, or under the previous
+            layout if the record has not been moved yet.
+        """
+        shard = self.shards[shard_index(email, len(self.shards))]
+        if not self.previous_shards:
+            return shard
+
+        previous = self.previous_shards[shard_index(email, len(self.previous_shards))]
+        if previous is shard or self._exists(shard, email) or not self._exists(previous, email):
+            return shard
+        return previous
+
+    def connection_for(self, email: str | None = None) -> psycopg.Connection[DictRow]:
+        if email is None:
+            return super().connection_for()
+        return self.shard_for(email).connection_for(email)
+
+    def execute_for(self, email: str, query: Template, commit: bool = False) -> dict[str, Any] | None:
+        """Run a statement on the shard that stores the record of a given email.
+
+        During a rebalance a statement can wait on a row that app.rebalance locked,
+        copied to its new shard and deleted, and then match nothing. When that
+        happens the email is routed again and the statement is retried on the
+        shard that now stores the record.
+        """
+        connection = self.connection_for(email)
+        row = self._execute_one(connection, query, commit)
+        if row is None and self.previous_shards:
+            rerouted = self.connection_for(email)
+            if rerouted is not connection:
+                row = self._execute_one(rerouted, query, commit)
+        return row
+
+    def create_table_bcrypt(self) -> None:
+        for shard in self.shards:
+            shard.create_table_bcrypt()
+
+    def configure_shard_ids_bcrypt(self) -> None:
+        """Make ids unique across the shards of the current layout.
+
+        Each shard issues ids congruent to its position in the layout, which is
+        why layouts may only grow by appending shards. A single database without
+        a previous layout keeps its ids as they are.
+        """
+        if len(self.shards) == 1 and not self.previous_shards:
+            return
+        for offset, shard in enumerate(self.shards):
+            shard.configure_ids_bcrypt(offset, floor=max(other.max_id_bcrypt() for other in self.read_shards))
+
+    def create_stats_bcrypt(self) -> None:
+        for shard in self.shards:
+            shard.create_stats_bcrypt()
+
+    def rollup_stats_bcrypt(self) -> None:
+        for shard in self.read_shards:
+            shard.rollup_stats_bcrypt()
+
+    def create_search_indexes_bcrypt(self) -> None:
+        for shard in self.shards:
+            shard.create_search_indexes_bcrypt()
+
+    def insert_data_bcrypt(self, person_data: dict[str, Any]) -> None:
+        self.shard_for(person_data['email']).insert_data_bcrypt(person_data)
+
+    def copy_data_bcrypt(self, rows: list[dict[str, Any]]) -> None:
+        batches: dict[int, list[dict[str, Any]]] = {}
+        for row in rows:
+            batches.setdefault(shard_index(row['email'], len(self.shards)), []).append(row)
+        for index, batch in batches.items():
+            self.shards[index].copy_data_bcrypt(batch)
+
+    def get_single_data_bcrypt(self, email: str) -> dict[str, Any] | None:
+        return self.execute_for(email, t"SELECT * FROM test_bcrypt WHERE email = {email}")
+
+    def get_hashed_password(self, email: str) -> str | None:
+        row = self.execute_for(email, t"SELECT hash_password FROM test_bcrypt WHERE email = {email}")
+        return None if row is None else row['hash_password']
+
+    def get_data_bcrypt(self, number: int = 100, descending: bool = False) -> list[dict[str, Any]]:
+        """Retrieve records from every shard merged in (created_at, email) order.
+
+        Each shard returns its own first `number` records in order, so the merged
+        result is the first `number` records across all shards.
+        """
+        results = [shard.get_data_bcrypt(number=number, descending=descending) for shard in self.read_shards]
+        merged = heapq.merge(*results, key=signup_order, reverse=descending)
+        return list(islice(unique_by_email(merged), number))
+
+    def search_data_bcrypt(self, query: str, limit: int = 20) -> list[dict[str, Any]]:
+        rows = [row for shard in self.read_shards for row in shard.search_data_bcrypt(query, limit=limit)]
+        rows.sort(key=lambda row: (not row['prefix_match'], -row['similarity'], row['email']))
+        return list(islice(unique_by_email(rows), limit))
+
+    def get_stats_bcrypt(self, age_bucket: int = 10, days: int = 30) -> dict[str, Any]:
+        merged: dict[str, Any] = {"total": 0, "by_gender": {}, "age_histogram": {}, "signups_per_day": {}}
+        for shard in self.read_shards:
+            stats = shard.get_stats_bcrypt(age_bucket=age_bucket, days=days)
+            merged["total"] += stats["total"]
+            for field in ("by_gender", "age_histogram", "signups_per_day"):
+                for key, count in stats[field].items():
+                    merged[field][key] = merged[field].get(key, 0) + count
+        merged["age_histogram"] = dict(sorted(merged["age_histogram"].items()))
+        merged["signups_per_day"] = dict(sorted(merged["signups_per_day"].items()))
+        return merged
@@ -0,0 +1,100 @@
+import asyncio
+import contextvars
+import hashlib
+import hmac
+import secrets
+from typing import Any, Awaitable, Callable, Hashable, TypeVar
+
+from app.load_control import DeadlineExceeded, check_deadline, remaining_seconds, request_deadline
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """Share one in-flight call between concurrent callers with the same key.
+
+    The first caller for a key starts the call, callers arriving while it runs
+    wait for the same result or exception. Nothing is kept once the call is
+    done, so later callers always start a fresh call.
+    """
+
+    def __init__(self) -> None:
+        self.calls: int = 0
+        self.executions: int = 0
+        self.saved: int = 0
+        self._flights: dict[Hashable, asyncio.Future[Any]] = {}
+
+    @property
+    def coalesced(self) -> int:
+        """The number of calls answered by another caller's execution."""
+        return self.calls - self.executions
+
+    def _finish(self, key: Hashable, flight: asyncio.Future[Any]) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not flight.cancelled():
+            flight.exception()
+
+    async def do(self, key: Hashable, call: Callable[[], Awaitable[T]], saves: Callable[[T], bool] | None = None) -> T:
+        """Run a call, or join the one already in flight for the same key.
+
+        The call runs in its own task without a request deadline, so a caller
+        that goes away or runs out of time does not cancel or cut it short for
+        the others. Each caller waits for it only until its own deadline.
+
+        Arguments:
+            key -- Identifies calls that are interchangeable.
+            call -- Starts the call when no identical one is in flight.
+
+        Keyword Arguments:
+            saves -- Tells from a result whether it took the work worth counting,
+                so joined callers that got such a result count as `saved` (default None).
+
+        Raises:
+            DeadlineExceeded: If the caller's deadline passes before the call is done.
+
+        Returns:
+            The result of the shared call.
+        """
+        check_deadline()
+        self.calls += 1
+        flight = self._flights.get(key)
+        joined = flight is not None
+        if flight is None:
+            self.executions += 1
+            context = contextvars.copy_context()
+            context.run(request_deadline.set, None)
+            flight = asyncio.get_running_loop().create_task(call(), context=context)
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._finish(key, done))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(flight), remaining_seconds())
+        except TimeoutError as error:
+            raise DeadlineExceeded("Request deadline exceeded.") from error
+        if joined and saves is not None and saves(result):
+            self.saved += 1
+        return result
+
+    def metrics(self) -> dict[str, int]:
+        """Return how many calls were made, executed, coalesced and saved."""
+        return {
+            "calls": self.calls,
+            "executions": self.executions,
+            "coalesced": self.coalesced,
+            "saved": self.saved,
+            "in_flight": len(self._flights),
+        }
+
+
+class CredentialKey:
+    """Build single-flight keys from credentials without keeping the password.
+
+    Passwords are reduced to an HMAC under a random key that only exists in
+    this process's memory.
+    """
+
+    def __init__(self) -> None:
+        self._secret = secrets.token_bytes(32)
+
+    def __call__(self, email: str, password: str) -> tuple[str, bytes]:
+        return email, hmac.new(self._secret, password.encode("utf-8"), hashlib.sha256).digest()